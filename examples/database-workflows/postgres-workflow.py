@@ -5,13 +5,63 @@ Demonstrates database operations with Claude Code and MCP Alchemy
 """
 
 import os
+import sys
 import subprocess
 import json
+import time
 from datetime import datetime
+from pathlib import Path
+from typing import Optional
+
+import anthropic
 
 # Database configuration
 DB_URL = os.getenv('DATABASE_URL', 'postgresql://localhost/dev_db')
 
+# Batch configuration
+MODEL = os.getenv('CLAUDE_MODEL', 'claude-sonnet-4-5')
+MAX_TOKENS = 4096
+
+# custom_id -> (prompt, output file)
+WORKFLOWS = {
+    # Workflow 1: Schema Analysis
+    "schema": (
+        "Analyze the database schema and create a visual diagram of relationships. "
+        "List all tables, their columns, data types, and foreign key relationships.",
+        "schema-diagram.md"
+    ),
+    # Workflow 2: Performance Analysis
+    "perf": (
+        "Review the schema for performance risks: "
+        "1. Identify foreign keys and commonly filtered columns without indexes, "
+        "2. Flag redundant or overlapping indexes, "
+        "3. Write SQL queries against pg_stat_statements and pg_stat_user_tables "
+        "to find slow queries and sequential scans, "
+        "4. Create index recommendations",
+        "performance-analysis.md"
+    ),
+    # Workflow 3: Data Validation
+    "validation": (
+        "Write SQL checks for data integrity based on the schema: "
+        "1. Queries that find orphaned records for each relationship, "
+        "including ones not enforced by a foreign key, "
+        "2. Queries that find duplicates on columns that should be unique, "
+        "3. Missing NOT NULL, UNIQUE and CHECK constraints, "
+        "4. Explain what each check detects",
+        "data-validation-report.md"
+    ),
+    # Workflow 4: Migration Script
+    "migration": (
+        "Create a migration script to: "
+        "1. Add missing indexes for the schema, "
+        "2. Add data validation constraints, "
+        "3. Create a rollback script, "
+        "4. Include safety checks. "
+        "Respond with SQL only.",
+        "migration-scripts.sql"
+    ),
+}
+
 def setup_mcp_alchemy():
     """
     Configure MCP Alchemy for PostgreSQL access
@@ -28,65 +78,112 @@ def setup_mcp_alchemy():
         }
     }
     
-    # Save to project MCP config
-    with open('.mcp.json', 'w') as f:
-        json.dump(config, f, indent=2)
+    # Save to project MCP config, leaving it untouched if nothing changed
+    # so MCP clients are not prompted to reload
+    config_file = Path('.mcp.json')
+    new = json.dumps(config, indent=2, sort_keys=True).encode()
+    if config_file.exists() and config_file.read_bytes() == new:
+        print(f"✅ MCP Alchemy already configured for: {DB_URL}")
+        return
+    
+    tmp_file = config_file.with_suffix('.json.tmp')
+    tmp_file.write_bytes(new)
+    os.replace(tmp_file, config_file)
     
     print(f"✅ MCP Alchemy configured for: {DB_URL}")
 
+def load_schema() -> Optional[str]:
+    """
+    Dump the schema so batched prompts have the same context MCP Alchemy gives
+
+    Returns None when pg_dump is missing, fails, or dumps nothing.
+    """
+    try:
+        result = subprocess.run(
+            ["pg_dump", "--schema-only", DB_URL],
+            capture_output=True,
+            text=True
+        )
+    except OSError as e:
+        print(f"❌ Could not run pg_dump: {e}")
+        return None
+    if result.returncode != 0:
+        print(f"❌ Could not dump schema: {result.stderr.strip()}")
+        return None
+    if not result.stdout.strip():
+        print("❌ pg_dump returned an empty schema")
+        return None
+    return result.stdout
+
+def wait_for_batch(client, batch_id: str):
+    """
+    Poll a message batch until processing has ended
+    """
+    delay = 5
+    while True:
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            return batch
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
+
 def run_database_workflow():
     """
     Execute a complete database workflow
+
+    The four analyses are independent, so they are submitted as a single
+    Message Batch instead of four sequential Claude Code runs. Without a
+    schema the model has nothing to analyze, so no batch is submitted.
     """
-    
-    # Workflow 1: Schema Analysis
-    print("\n📊 Analyzing Database Schema...")
-    subprocess.run([
-        "claude", "-p",
-        "Analyze the database schema and create a visual diagram of relationships. "
-        "List all tables, their columns, data types, and foreign key relationships.",
-        "--allowedTools", "Task,Write"
-    ])
-    
-    # Workflow 2: Performance Analysis
-    print("\n⚡ Running Performance Analysis...")
-    subprocess.run([
-        "claude", "-p",
-        "think hard about database performance: "
-        "1. Identify missing indexes, "
-        "2. Find slow queries, "
-        "3. Suggest optimization strategies, "
-        "4. Create index recommendations",
-        "--allowedTools", "Write"
-    ])
-    
-    # Workflow 3: Data Validation
-    print("\n✓ Validating Data Integrity...")
-    subprocess.run([
-        "claude", "-p",
-        "Check data integrity across all tables: "
-        "1. Find orphaned records, "
-        "2. Validate foreign key constraints, "
-        "3. Check for duplicate data, "
-        "4. Identify data anomalies",
-        "--allowedTools", "Write"
-    ])
-    
-    # Workflow 4: Migration Script
-    print("\n🔄 Generating Migration Scripts...")
-    subprocess.run([
-        "claude", "-p",
-        "Create a migration script to: "
-        "1. Add missing indexes identified earlier, "
-        "2. Add data validation constraints, "
-        "3. Create a rollback script, "
-        "4. Include safety checks",
-        "--allowedTools", "Write"
+    schema = load_schema()
+    if schema is None:
+        print("❌ Aborting: the analyses need the database schema")
+        return False
+
+    client = anthropic.Anthropic()
+
+    print("\n📦 Submitting database workflow batch...")
+    batch = client.messages.batches.create(requests=[
+        {
+            "custom_id": custom_id,
+            "params": {
+                "model": MODEL,
+                "max_tokens": MAX_TOKENS,
+                "messages": [{
+                    "role": "user",
+                    "content": f"{prompt}\n\nDatabase schema:\n{schema}"
+                }]
+            }
+        }
+        for custom_id, (prompt, _) in WORKFLOWS.items()
     ])
 
+    print(f"⏳ Waiting for batch {batch.id}...")
+    wait_for_batch(client, batch.id)
+
+    success = True
+    for entry in client.messages.batches.results(batch.id):
+        _, output_file = WORKFLOWS[entry.custom_id]
+        if entry.result.type != "succeeded":
+            print(f"❌ {entry.custom_id} failed: {entry.result.type}")
+            success = False
+            continue
+
+        text = "".join(
+            block.text for block in entry.result.message.content
+            if block.type == "text"
+        )
+        with open(output_file, 'w') as f:
+            f.write(text)
+        print(f"✅ {entry.custom_id} → {output_file}")
+
+    return success
+
 def run_specific_query(query: str):
     """
     Run a specific database query through Claude
+
+    Interactive, tool-using flows like this stay on the Claude Code CLI.
     """
     subprocess.run([
         "claude", "-p",
@@ -102,7 +199,8 @@ if __name__ == "__main__":
     setup_mcp_alchemy()
     
     # Run the workflow
-    run_database_workflow()
+    if not run_database_workflow():
+        sys.exit(1)
     
     # Example: Run a specific query
     # run_specific_query("SELECT COUNT(*) FROM users WHERE created_at > NOW() - INTERVAL '7 days'")
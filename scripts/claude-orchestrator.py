@@ -4,15 +4,35 @@ Claude Orchestrator
 Coordinates workflows between Claude Desktop and Claude Code
 """
 
-import subprocess
+import ast
+import hashlib
 import json
+import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
 import sys
+import tempfile
+import threading
 import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import deque
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Callable, Coroutine, FrozenSet, Union
 import asyncio
 from enum import Enum
+from functools import lru_cache
+from pathlib import Path
+from types import CodeType, MappingProxyType
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson is optional
+    orjson = None
 
 class ClaudeTool(Enum):
     """Available Claude tools"""
@@ -37,28 +57,523 @@ class ThinkLevel(Enum):
     ULTRATHINK = "ultrathink"
     MEGATHINK = "megathink"
 
+@lru_cache(maxsize=None)
+def _tool(name: str) -> ClaudeTool:
+    """Resolve a workflow tool entry, given as a value ("Read") or name ("READ")"""
+    try:
+        return ClaudeTool(name)
+    except ValueError:
+        return ClaudeTool[name]
+
+@lru_cache(maxsize=None)
+def _think(name: str) -> ThinkLevel:
+    """Resolve a workflow think_level entry"""
+    return ThinkLevel(name)
+
+def _step_name(step: Dict[str, Any], index: int) -> str:
+    return step.get("name", f"Step {index+1}")
+
+def _is_noop(step: Dict[str, Any]) -> bool:
+    """Whether a step statically does nothing when executed"""
+    
+    step_type = step.get("type", "claude_code")
+    if step_type == "wait":
+        return step.get("seconds", 1) == 0
+    if step_type == "conditional":
+        if not step.get("steps"):
+            return True
+        try:
+            return not ast.literal_eval(step.get("condition") or "False")
+        except (ValueError, SyntaxError):
+            return False
+    return False
+
+def _prune_steps(steps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Drop no-op steps, including inside conditionals
+    
+    Steps that depended on a pruned step inherit its dependencies, so the
+    original ordering is preserved. Unnamed steps are given their default
+    name first, so pruning doesn't shift the names later steps depend on.
+    """
+    
+    kept = []
+    pruned_deps: Dict[str, List[str]] = {}
+    for i, step in enumerate(steps):
+        if "name" not in step:
+            step = {**step, "name": _step_name(step, i)}
+        if step.get("type") == "conditional" and step.get("steps"):
+            step = {**step, "steps": _prune_steps(step["steps"])}
+        if _is_noop(step):
+            pruned_deps[_step_name(step, i)] = step.get("depends_on", [])
+        else:
+            kept.append(step)
+    
+    # A name still used by a kept step remains a valid dependency
+    for step in kept:
+        pruned_deps.pop(step["name"], None)
+    
+    def resolve(name: str, seen: FrozenSet[str]) -> List[str]:
+        if name not in pruned_deps or name in seen:
+            return [name]
+        return [dep for parent in pruned_deps[name] for dep in resolve(parent, seen | {name})]
+    
+    if pruned_deps:
+        for i, step in enumerate(kept):
+            if "depends_on" in step:
+                deps = [dep for name in step["depends_on"] for dep in resolve(name, frozenset())]
+                kept[i] = {**step, "depends_on": list(dict.fromkeys(deps))}
+    
+    return kept
+
+def _compile_dag(steps: List[Dict[str, Any]]) -> List[FrozenSet[int]]:
+    """Map each step's depends_on names to the indices of the steps it waits for
+    
+    Raises ValueError for unknown dependencies and dependency cycles.
+    """
+    
+    indices: Dict[str, List[int]] = {}
+    for i, step in enumerate(steps):
+        indices.setdefault(_step_name(step, i), []).append(i)
+    
+    dag = []
+    for i, step in enumerate(steps):
+        unknown = [name for name in step.get("depends_on", []) if name not in indices]
+        if unknown:
+            raise ValueError(f"Step {_step_name(step, i)} depends on unknown steps: {unknown}")
+        dag.append(frozenset(j for name in step.get("depends_on", []) for j in indices[name]))
+    
+    pending = {i: set(deps) for i, deps in enumerate(dag)}
+    while pending:
+        ready = {i for i, deps in pending.items() if not deps & pending.keys()}
+        if not ready:
+            stuck = [_step_name(steps[i], i) for i in pending]
+            raise ValueError(f"Dependency cycle between steps: {stuck}")
+        for i in ready:
+            del pending[i]
+    return dag
+
+def dump_json(obj: Any, pretty: bool = False) -> bytes:
+    """Serialize to JSON bytes, using orjson when it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0)
+    if pretty:
+        return json.dumps(obj, indent=2).encode()
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+# Builtins available to conditional step expressions
+CONDITION_BUILTINS = {
+    "len": len, "any": any, "all": all, "min": min, "max": max,
+    "sum": sum, "bool": bool, "int": int, "str": str,
+    "True": True, "False": False, "None": None
+}
+
+# Expression nodes that open a new scope or code object inside a condition
+FORBIDDEN_CONDITION_NODES = (
+    ast.Lambda, ast.GeneratorExp, ast.ListComp, ast.SetComp, ast.DictComp, ast.NamedExpr
+)
+
+# The only methods a condition may call; all of them leave their object unchanged
+CONDITION_METHODS = frozenset({
+    "get", "keys", "values", "items", "count", "index",
+    "startswith", "endswith", "lower", "upper", "strip", "split"
+})
+
+def _readonly(value: Any) -> Any:
+    """Return an immutable copy of JSON-like data for condition scopes"""
+    if isinstance(value, dict):
+        return MappingProxyType({k: _readonly(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(_readonly(v) for v in value)
+    return value
+
+# Tools whose side effects make it unsafe to merge prompts into one call
+STATEFUL_TOOLS = frozenset({ClaudeTool.WRITE, ClaudeTool.EDIT, ClaudeTool.BASH})
+
+LOG_FORMAT = logging.Formatter("[%(asctime)s] [%(label)s] %(message)s", "%Y-%m-%d %H:%M:%S")
+
+# Error output that means the call is worth retrying after a pause
+RETRYABLE_ERROR = re.compile(r"rate.?limit|overloaded|\b(429|529)\b", re.IGNORECASE)
+
+# First line of output whose start was dropped by max_output_lines
+TRUNCATED_PREFIX = "[output truncated: "
+
+class PersistentCLIUnavailable(Exception):
+    """Raised when the claude CLI cannot be kept running in stream-json mode"""
+
+class ClaudeRateLimited(Exception):
+    """Raised when Claude rejects a call because of rate limiting or overload"""
+
+class AsyncBatcher(ABC):
+    """Coalesces concurrent requests into batches
+    
+    Items submitted through process() are queued until max_batch_size items
+    are waiting or max_queue_time milliseconds have passed since the first
+    one, then handed to process_batch() together. Subclasses implement
+    process_batch.
+    """
+    
+    def __init__(self, max_batch_size: int = 5, max_queue_time: float = 50):
+        self.max_batch_size = max_batch_size
+        self.max_queue_time = max_queue_time
+        self._queue: List[Any] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._tasks: set = set()
+    
+    async def process(self, item: Any) -> Any:
+        """Queue an item and wait for its result"""
+        
+        loop = asyncio.get_running_loop()
+        item.future = loop.create_future()
+        self._queue.append(item)
+        
+        if len(self._queue) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_queue_time / 1000, self._flush)
+        
+        return await item.future
+    
+    def _flush(self):
+        """Hand the queued items to process_batch"""
+        
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+    
+    async def _run_batch(self, batch: List[Any]):
+        try:
+            await self.process_batch(batch)
+        except Exception as e:
+            for item in batch:
+                if not item.future.done():
+                    item.future.set_exception(e)
+    
+    @abstractmethod
+    async def process_batch(self, batch: List[Any]):
+        """Resolve the future of every item in the batch"""
+
+@dataclass
+class PromptItem:
+    """A queued run_claude_code call"""
+    prompt: str
+    tools: Tuple[ClaudeTool, ...]
+    think_level: ThinkLevel
+    timeout: Optional[int] = None
+    future: Optional[asyncio.Future] = field(default=None, repr=False)
+
+class PromptBatcher(AsyncBatcher):
+    """Merges compatible prompts into a single Claude Code invocation"""
+    
+    def __init__(self, orchestrator: "ClaudeOrchestrator", **kwargs):
+        super().__init__(**kwargs)
+        self.orchestrator = orchestrator
+    
+    async def process_batch(self, batch: List[PromptItem]):
+        # Only prompts with the same tools and think level can share a call
+        groups: Dict[Tuple[Any, ...], List[PromptItem]] = {}
+        for item in batch:
+            key = (frozenset(item.tools), item.think_level)
+            groups.setdefault(key, []).append(item)
+        
+        await asyncio.gather(*[self._run_group(group) for group in groups.values()])
+    
+    async def _run_group(self, group: List[PromptItem]):
+        first = group[0]
+        timeouts = [item.timeout for item in group]
+        timeout = None if None in timeouts else max(timeouts)
+        
+        if len(group) == 1:
+            result = await self._execute(first.prompt, first, timeout)
+            if not first.future.done():
+                first.future.set_result(result)
+            return
+        
+        tasks = "\n".join(f"{i}) {item.prompt}" for i, item in enumerate(group, 1))
+        prompt = (
+            f"Perform the following {len(group)} independent tasks and return "
+            f"results as JSON keyed by index:\n{tasks}\n\n"
+            "Respond with only a JSON object mapping each task number "
+            "(as a string) to that task's result."
+        )
+        
+        results = self._parse_results(await self._execute(prompt, first, timeout))
+        
+        missing = []
+        for i, item in enumerate(group, 1):
+            result = results.get(str(i))
+            if result is None:
+                missing.append(item)
+                continue
+            if not isinstance(result, str):
+                result = json.dumps(result)
+            if not item.future.done():
+                item.future.set_result(result)
+        
+        if missing:
+            # Claude skipped or garbled these tasks; run them on their own, in parallel
+            self.orchestrator.log(
+                f"{len(missing)} batched task(s) missing from response, retrying alone", "WARNING"
+            )
+            retried = await asyncio.gather(
+                *[self._execute(item.prompt, item, item.timeout) for item in missing]
+            )
+            for item, result in zip(missing, retried):
+                if not item.future.done():
+                    item.future.set_result(result)
+    
+    async def _execute(
+        self,
+        prompt: str,
+        item: PromptItem,
+        timeout: Optional[int]
+    ) -> Optional[str]:
+        return await self.orchestrator._execute_async(
+            prompt,
+            list(item.tools),
+            item.think_level,
+            timeout
+        )
+    
+    @staticmethod
+    def _parse_results(output: Optional[str]) -> Dict[str, Any]:
+        """Extract the JSON object of per-task results from Claude's output"""
+        
+        if not output:
+            return {}
+        
+        start, end = output.find("{"), output.rfind("}")
+        try:
+            results = json.loads(output[start:end + 1])
+        except ValueError:
+            return {}
+        
+        return results if isinstance(results, dict) else {}
+
 class ClaudeOrchestrator:
     """Orchestrates workflows between Claude Desktop and Claude Code"""
     
-    def __init__(self, debug: bool = False):
+    # --allowedTools argv per distinct tool set, shared by all instances
+    _tool_argv_cache: Dict[Optional[frozenset], Tuple[str, ...]] = {}
+    
+    # Set once the workflows directory has been created in this process
+    _workflows_dir_ready: bool = False
+    
+    def __init__(
+        self,
+        debug: bool = False,
+        max_parallel: Optional[int] = None,
+        max_retries: int = 3,
+        persistent_cli: bool = False,
+        max_session_turns: int = 20,
+        batch_prompts: bool = False,
+        max_batch_size: int = 5,
+        max_queue_time: float = 50,
+        cache_dir: Path = Path(".claude_cache"),
+        use_cache: bool = True,
+        cache_ttl: Optional[float] = 24 * 60 * 60,
+        max_output_lines: Optional[int] = None
+    ):
         self.debug = debug
+        self.max_parallel = max_parallel or int(os.getenv("CLAUDE_MAX_CONCURRENCY", "10"))
+        self.max_retries = max_retries
+        self.persistent_cli = persistent_cli
+        self.max_session_turns = max_session_turns
+        self.batch_prompts = batch_prompts
+        self._batcher = PromptBatcher(
+            self,
+            max_batch_size=max_batch_size,
+            max_queue_time=max_queue_time
+        )
+        self.cache_dir = Path(cache_dir)
+        self.use_cache = use_cache
+        self.cache_ttl = cache_ttl
+        self.max_output_lines = max_output_lines
         self.workflow_history = []
+        self._history_flushed_idx = 0
+        self._cond_cache: Dict[str, CodeType] = {}
+        self._history_view: Tuple[Any, ...] = ()
+        self._env_view: Optional[MappingProxyType] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._semaphore_loop: Optional[asyncio.AbstractEventLoop] = None
+        
+        # Long-lived claude processes, owned by a background event loop
+        self._proc_pool: List[asyncio.subprocess.Process] = []
+        self._proc_queues: Dict[Tuple[str, ...], asyncio.Queue] = {}
+        self._proc_turns: Dict[asyncio.subprocess.Process, int] = {}
+        self._persistent_unsupported = False
+        self._dispatch_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._dispatch_thread: Optional[threading.Thread] = None
+        self._dispatch_lock = threading.Lock()
+        
+        # Log calls only enqueue; a background listener formats and writes
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(LOG_FORMAT)
+        self._log_queue: queue.Queue = queue.Queue(-1)
+        self._listener = logging.handlers.QueueListener(self._log_queue, handler)
+        self._listener.start()
+        self._stop_listener = weakref.finalize(self, self._listener.stop)
+        
+        self._logger = logging.Logger("claude_orchestrator", logging.DEBUG)
+        self._logger.addHandler(logging.handlers.QueueHandler(self._log_queue))
         
     def log(self, message: str, level: str = "INFO"):
-        """Log messages with timestamp"""
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        print(f"[{timestamp}] [{level}] {message}")
+        """Log messages with timestamp
+        
+        Any level string is accepted and printed as given; names logging
+        doesn't know (such as "SUCCESS") are logged at INFO.
+        """
+        levelno = logging.getLevelName(level)
+        if not isinstance(levelno, int):
+            levelno = logging.INFO
+        self._logger.log(levelno, "%s", message, extra={"label": level})
         
     def run_claude_code(
         self,
         prompt: str,
         tools: Optional[List[ClaudeTool]] = None,
         think_level: ThinkLevel = ThinkLevel.NORMAL,
-        timeout: Optional[int] = None
+        timeout: Optional[int] = None,
+        on_chunk: Optional[Callable[[bytes], None]] = None
     ) -> Optional[str]:
-        """Execute Claude Code with specified parameters"""
+        """Execute Claude Code with specified parameters
+        
+        Blocking wrapper around _run_claude_code_async; call that directly
+        from within a running event loop.
+        """
+        
+        return asyncio.run(
+            self._run_claude_code_async(prompt, tools, think_level, timeout, on_chunk)
+        )
+    
+    async def _run_claude_code_async(
+        self,
+        prompt: str,
+        tools: Optional[List[ClaudeTool]] = None,
+        think_level: ThinkLevel = ThinkLevel.NORMAL,
+        timeout: Optional[int] = None,
+        on_chunk: Optional[Callable[[bytes], None]] = None
+    ) -> Optional[str]:
+        """Execute Claude Code with specified parameters
+        
+        Results are cached on disk under cache_dir, keyed by prompt, tools and
+        think level. With batch_prompts enabled, concurrent calls that share
+        tools and think level are merged into one invocation. Calls using
+        stateful tools (Write, Edit, Bash) are never cached or batched.
+        
+        on_chunk receives each stdout line as it arrives from a spawned CLI;
+        pooled and batched calls only return the final result. Output longer
+        than max_output_lines keeps only its last lines, behind a
+        TRUNCATED_PREFIX marker line, and is not cached.
+        """
+        
+        if STATEFUL_TOOLS.intersection(tools or []):
+            return await self._execute_async(prompt, tools, think_level, timeout, on_chunk)
+        
+        tool_names = self._tool_argv(tools)
+        key = self._cache_key(prompt, tool_names, think_level)
+        
+        if self.use_cache:
+            cached = self._cache_get(key)
+            if cached is not None:
+                self.log(f"Cache hit: {key[:12]}")
+                # Record hits too, so history does not depend on cache state
+                self.workflow_history.append({
+                    "timestamp": datetime.now().isoformat(),
+                    "type": "claude_code",
+                    "prompt": self._build_command(prompt, tool_names, think_level)[2],
+                    "tools": tool_names,
+                    "think_level": think_level.value,
+                    "output_bytes": len(cached.encode()),
+                    "success": True,
+                    "cached": True
+                })
+                return cached
+        
+        if self.batch_prompts:
+            item = PromptItem(prompt, tuple(tools or ()), think_level, timeout)
+            output = await self._on_dispatch_loop(self._batcher.process(item))
+        else:
+            output = await self._execute_async(prompt, tools, think_level, timeout, on_chunk)
+        
+        # Truncated output is not the full answer, so never serve it from cache
+        if output is not None and self.use_cache and not output.startswith(TRUNCATED_PREFIX):
+            try:
+                self._cache_put(key, output, self._build_command(prompt, tool_names, think_level))
+            except OSError as e:
+                self.log(f"Could not write cache entry {key[:12]}: {e}", "WARNING")
+        
+        return output
+    
+    @classmethod
+    def _tool_argv(cls, tools: Optional[List[ClaudeTool]]) -> Tuple[str, ...]:
+        """Return the CLI tool names for a tool list, memoized by tool set"""
+        
+        key = frozenset(tools) if tools else None
+        argv = cls._tool_argv_cache.get(key)
+        if argv is None:
+            argv = tuple(tool.value for tool in tools) if tools else ()
+            cls._tool_argv_cache[key] = argv
+        return argv
+    
+    @staticmethod
+    def _cache_key(prompt: str, tool_names: Tuple[str, ...], think_level: ThinkLevel) -> str:
+        """Content address for a Claude Code call"""
+        
+        payload = {"p": prompt, "t": sorted(tool_names), "l": think_level.value}
+        return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+    
+    def _cache_get(self, key: str) -> Optional[str]:
+        """Return the cached output for key, unless missing, malformed or expired
+        
+        cache_ttl is in seconds; None keeps entries forever.
+        """
+        
+        try:
+            with open(self.cache_dir / f"{key}.json") as f:
+                entry = json.load(f)
+            if self.cache_ttl is not None and time.time() - entry["ts"] > self.cache_ttl:
+                return None
+            stdout = entry["stdout"]
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+        
+        return stdout if isinstance(stdout, str) else None
+    
+    def _cache_put(self, key: str, stdout: str, cmd: List[str]):
+        """Store output for key, replacing any previous entry atomically"""
+        
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.cache_dir, suffix=".tmp", delete=False
+        ) as f:
+            json.dump({"stdout": stdout, "ts": time.time(), "cmd": cmd}, f)
+        os.replace(f.name, self.cache_dir / f"{key}.json")
+    
+    def invalidate(self, prefix: str = "") -> int:
+        """Remove cached results whose key starts with prefix, returning the count"""
+        
+        removed = 0
+        for path in self.cache_dir.glob(f"{prefix}*.json"):
+            path.unlink()
+            removed += 1
+        
+        self.log(f"Invalidated {removed} cached results")
+        return removed
+    
+    def _build_command(
+        self,
+        prompt: str,
+        tool_names: Tuple[str, ...],
+        think_level: ThinkLevel
+    ) -> List[str]:
+        """Build the claude CLI argv for a prompt"""
         
-        # Build command
         cmd = ["claude"]
         
         # Add thinking level to prompt if specified
@@ -68,9 +583,25 @@ class ClaudeOrchestrator:
         cmd.extend(["-p", prompt])
         
         # Add allowed tools
-        if tools:
-            tool_names = [tool.value for tool in tools]
-            cmd.extend(["--allowedTools"] + tool_names)
+        if tool_names:
+            cmd.extend(["--allowedTools", *tool_names])
+        
+        return cmd
+    
+    async def _execute_async(
+        self,
+        prompt: str,
+        tools: Optional[List[ClaudeTool]] = None,
+        think_level: ThinkLevel = ThinkLevel.NORMAL,
+        timeout: Optional[int] = None,
+        on_chunk: Optional[Callable[[bytes], None]] = None
+    ) -> Optional[str]:
+        """Run a single Claude Code invocation"""
+        
+        # Build command
+        tool_names = self._tool_argv(tools)
+        cmd = self._build_command(prompt, tool_names, think_level)
+        prompt = cmd[2]
         
         # Log execution
         self.log(f"Running Claude Code: {' '.join(cmd[:3])}...")
@@ -78,51 +609,337 @@ class ClaudeOrchestrator:
             self.log(f"Full command: {' '.join(cmd)}", "DEBUG")
         
         try:
-            # Execute command
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=timeout
-            )
+            # Execute command, backing off while Claude is rate limited
+            for attempt in range(self.max_retries + 1):
+                if self.persistent_cli:
+                    run = self._run_persistent(cmd, prompt, tool_names, on_chunk)
+                else:
+                    run = self._run_once(cmd, on_chunk)
+                try:
+                    output = await asyncio.wait_for(run, timeout)
+                    break
+                except ClaudeRateLimited as e:
+                    if attempt == self.max_retries:
+                        raise
+                    delay = min(60, 2 ** attempt) + random.random()
+                    self.log(f"Rate limited ({e}), retrying in {delay:.1f}s", "WARNING")
+                    await asyncio.sleep(delay)
             
-            if result.returncode != 0:
-                self.log(f"Error: {result.stderr}", "ERROR")
+            if output is None:
                 return None
             
             # Record in history
+            output_bytes = len(output) if isinstance(output, bytes) else len(output.encode())
             self.workflow_history.append({
                 "timestamp": datetime.now().isoformat(),
                 "type": "claude_code",
                 "prompt": prompt,
-                "tools": [tool.value for tool in tools] if tools else [],
+                "tools": tool_names,
                 "think_level": think_level.value,
+                "output_bytes": output_bytes,
                 "success": True
             })
             
-            return result.stdout
+            # Spawned CLIs hand back raw stdout; decode it exactly once
+            if isinstance(output, bytes):
+                return output.decode("utf-8", "replace")
+            return output
             
-        except subprocess.TimeoutExpired:
+        except asyncio.TimeoutError:
             self.log("Command timed out", "ERROR")
             return None
+        except ClaudeRateLimited as e:
+            self.log(f"Still rate limited after {self.max_retries} retries: {e}", "ERROR")
+            return None
         except Exception as e:
             self.log(f"Exception: {str(e)}", "ERROR")
             return None
     
+    async def _run_once(
+        self,
+        cmd: List[str],
+        on_chunk: Optional[Callable[[bytes], None]] = None
+    ) -> Optional[bytes]:
+        """Spawn a dedicated claude process for a single prompt, returning raw stdout"""
+        
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stderr = asyncio.ensure_future(proc.stderr.read())
+        buf = deque(maxlen=self.max_output_lines)
+        dropped = 0
+        
+        def add_line(line: bytes):
+            nonlocal dropped
+            if len(buf) == buf.maxlen:
+                dropped += 1
+            buf.append(line)
+            if on_chunk:
+                on_chunk(line)
+        
+        try:
+            # Read fixed-size chunks so a single huge line cannot overrun
+            # the stream's line limit, then split them into lines ourselves
+            partial: List[bytes] = []
+            while True:
+                chunk = await proc.stdout.read(1 << 16)
+                if not chunk:
+                    break
+                *lines, rest = chunk.split(b"\n")
+                for piece in lines:
+                    partial.append(piece + b"\n")
+                    add_line(b"".join(partial))
+                    partial = []
+                if rest:
+                    partial.append(rest)
+            if partial:
+                add_line(b"".join(partial))
+            returncode = await proc.wait()
+        except BaseException:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            stderr.cancel()
+            raise
+        
+        if returncode != 0:
+            error = (await stderr).decode("utf-8", "replace")
+            if RETRYABLE_ERROR.search(error):
+                raise ClaudeRateLimited(error.strip())
+            self.log(f"Error: {error}", "ERROR")
+            return None
+        
+        await stderr
+        if dropped:
+            self.log(f"Output exceeded max_output_lines, dropped {dropped} earlier lines", "WARNING")
+            marker = f"{TRUNCATED_PREFIX}{dropped} earlier lines dropped]\n".encode()
+            return b"".join([marker, *buf])
+        return b"".join(buf)
+    
+    async def _run_persistent(
+        self,
+        cmd: List[str],
+        prompt: str,
+        tool_names: Tuple[str, ...],
+        on_chunk: Optional[Callable[[bytes], None]] = None
+    ) -> Optional[Union[str, bytes]]:
+        """Send a prompt to a pooled claude process, spawning per call if unsupported
+        
+        A process that fails before its first reply means the CLI cannot run
+        in stream-json mode, so every later call spawns per call instead.
+        Failures later in a session only fall back for the current call.
+        """
+        
+        if self._persistent_unsupported:
+            return await self._run_once(cmd, on_chunk)
+        
+        try:
+            return await self._on_dispatch_loop(self._dispatch(prompt, tool_names))
+        except PersistentCLIUnavailable as e:
+            if self._persistent_unsupported:
+                self.log(f"Persistent CLI unsupported ({e}), spawning per call from now on", "WARNING")
+            else:
+                self.log(f"Persistent CLI unavailable ({e}), spawning for this call", "WARNING")
+            return await self._run_once(cmd, on_chunk)
+    
+    async def _on_dispatch_loop(self, coro: Coroutine[Any, Any, Any]) -> Any:
+        """Await a coroutine on the dispatch loop that owns the pool and batcher"""
+        
+        loop = self._get_dispatch_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+    
+    def _get_dispatch_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the background event loop that owns the process pool"""
+        
+        with self._dispatch_lock:
+            if self._dispatch_loop is None:
+                loop = asyncio.new_event_loop()
+                self._dispatch_thread = threading.Thread(
+                    target=loop.run_forever,
+                    name="claude-dispatch",
+                    daemon=True
+                )
+                self._dispatch_thread.start()
+                self._dispatch_loop = loop
+            return self._dispatch_loop
+    
+    async def _spawn_persistent(
+        self,
+        tool_names: Tuple[str, ...]
+    ) -> asyncio.subprocess.Process:
+        """Launch a claude process that reads prompts as stream-json on stdin"""
+        
+        cmd = [
+            "claude", "-p",
+            "--input-format", "stream-json",
+            "--output-format", "stream-json",
+            "--verbose"
+        ]
+        if tool_names:
+            cmd.extend(["--allowedTools", *tool_names])
+        
+        if self.debug:
+            self.log(f"Spawning persistent CLI: {' '.join(cmd)}", "DEBUG")
+        
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=1 << 20
+        )
+        self._proc_pool.append(proc)
+        return proc
+    
+    async def _dispatch(self, prompt: str, tool_names: Tuple[str, ...]) -> Optional[str]:
+        """Run one prompt on a pooled process and return its result text
+        
+        Processes are keyed by their allowed tool set, since --allowedTools is
+        fixed for the lifetime of a process. Each set gets up to max_parallel
+        processes, spawned lazily; the LIFO queue hands out warm ones first.
+        
+        A session keeps every earlier prompt in its context, so it is
+        replaced after an error result or after max_session_turns turns.
+        """
+        
+        idle = self._proc_queues.get(tool_names)
+        if idle is None:
+            idle = asyncio.LifoQueue()
+            for _ in range(self.max_parallel):
+                idle.put_nowait(None)
+            self._proc_queues[tool_names] = idle
+        
+        proc = await idle.get()
+        try:
+            if proc is not None and proc.returncode is not None:
+                await self._discard_proc(proc)
+                proc = None
+            if proc is None:
+                if self._persistent_unsupported:
+                    raise PersistentCLIUnavailable("claude does not support stream-json input")
+                proc = await self._spawn_persistent(tool_names)
+            
+            request = {"type": "user", "message": {"role": "user", "content": prompt}}
+            try:
+                proc.stdin.write(json.dumps(request).encode() + b"\n")
+                await proc.stdin.drain()
+            except ConnectionError:
+                raise PersistentCLIUnavailable("claude exited before reading the prompt")
+            
+            # Skip streamed events until the turn's result message
+            while True:
+                line = await self._read_line(proc.stdout)
+                if not line:
+                    raise PersistentCLIUnavailable("claude exited before replying")
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    raise PersistentCLIUnavailable("claude did not reply with stream-json")
+                if event.get("type") == "result":
+                    break
+            
+        except BaseException as e:
+            # The process is mid-turn or dead; never hand it out again
+            if isinstance(e, PersistentCLIUnavailable) and not self._proc_turns.get(proc):
+                self._persistent_unsupported = True
+            if proc is not None:
+                dead, proc = proc, None
+                await self._discard_proc(dead)
+            raise
+        else:
+            error = str(event.get("result")) if event.get("is_error") else None
+            rate_limited = error is not None and RETRYABLE_ERROR.search(error)
+            turns = self._proc_turns[proc] = self._proc_turns.get(proc, 0) + 1
+            if (error is not None and not rate_limited) or turns >= self.max_session_turns:
+                dead, proc = proc, None
+                await self._discard_proc(dead)
+        finally:
+            idle.put_nowait(proc)
+        
+        if error is not None:
+            if rate_limited:
+                raise ClaudeRateLimited(error)
+            self.log(f"Error: {error}", "ERROR")
+            return None
+        
+        return event.get("result")
+    
+    @staticmethod
+    async def _read_line(stream: asyncio.StreamReader) -> bytes:
+        """Read one line of any length, returning b"" at EOF
+        
+        StreamReader.readline() gives up on lines longer than the stream
+        limit; readuntil() leaves them buffered, so take them in pieces.
+        """
+        
+        parts = []
+        while True:
+            try:
+                parts.append(await stream.readuntil(b"\n"))
+                break
+            except asyncio.IncompleteReadError as e:
+                parts.append(e.partial)
+                break
+            except asyncio.LimitOverrunError as e:
+                parts.append(await stream.readexactly(e.consumed))
+        return b"".join(parts)
+    
+    async def _discard_proc(self, proc: asyncio.subprocess.Process):
+        """Kill a pooled process, reap it and drop it from the pool"""
+        
+        if proc in self._proc_pool:
+            self._proc_pool.remove(proc)
+        self._proc_turns.pop(proc, None)
+        proc.stdin.close()
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+    
+    async def _close_pool(self):
+        """Terminate all pooled claude processes"""
+        
+        for proc in self._proc_pool:
+            proc.stdin.close()
+            if proc.returncode is None:
+                proc.kill()
+            await proc.wait()
+        self._proc_pool.clear()
+        self._proc_queues.clear()
+        self._proc_turns.clear()
+    
+    def close(self):
+        """Release background resources held by the orchestrator"""
+        
+        with self._dispatch_lock:
+            loop, self._dispatch_loop = self._dispatch_loop, None
+        
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self._close_pool(), loop).result()
+            loop.call_soon_threadsafe(loop.stop)
+            self._dispatch_thread.join()
+            loop.close()
+        
+        # Flush pending log records and stop the listener thread
+        self._stop_listener()
+    
     async def run_parallel_tasks(
         self,
         tasks: List[Dict[str, Any]]
     ) -> List[Optional[str]]:
-        """Run multiple Claude Code tasks in parallel"""
+        """Run multiple Claude Code tasks in parallel, at most max_parallel at a time"""
         
         async def run_task(task):
-            return await asyncio.to_thread(
-                self.run_claude_code,
-                task["prompt"],
-                task.get("tools"),
-                task.get("think_level", ThinkLevel.NORMAL),
-                task.get("timeout")
-            )
+            async with self._get_semaphore():
+                return await self._run_claude_code_async(
+                    task["prompt"],
+                    task.get("tools"),
+                    task.get("think_level", ThinkLevel.NORMAL),
+                    task.get("timeout")
+                )
         
         self.log(f"Running {len(tasks)} tasks in parallel...")
         results = await asyncio.gather(*[run_task(task) for task in tasks])
@@ -135,86 +952,271 @@ class ClaudeOrchestrator:
         description: str,
         steps: List[Dict[str, Any]]
     ) -> Dict[str, Any]:
-        """Create a reusable workflow definition"""
+        """Create a reusable workflow definition
+        
+        No-op steps (zero-second waits, conditionals that can never run) are
+        pruned. The compiled dependency DAG is saved in the definition as
+        ``dag`` (lists of step indices), with a digest of the steps it was
+        compiled from.
+        """
         
         workflow = {
             "name": name,
             "description": description,
             "created": datetime.now().isoformat(),
-            "steps": steps
+            "steps": _prune_steps(steps)
         }
         
+        try:
+            dag = _compile_dag(workflow["steps"])
+        except ValueError as e:
+            self.log(f"Not compiling workflow {name}: {e}", "WARNING")
+        else:
+            workflow["dag"] = [sorted(deps) for deps in dag]
+            workflow["dag_digest"] = self._steps_digest(workflow["steps"])
+        
         # Save workflow
-        workflow_file = f"workflows/{name.lower().replace(' ', '-')}.json"
-        os.makedirs("workflows", exist_ok=True)
+        slug = name.lower().replace(' ', '-')
+        if not ClaudeOrchestrator._workflows_dir_ready:
+            os.makedirs("workflows", exist_ok=True)
+            ClaudeOrchestrator._workflows_dir_ready = True
         
-        with open(workflow_file, 'w') as f:
-            json.dump(workflow, f, indent=2)
+        self._write_atomic(Path("workflows") / f"{slug}.json", dump_json(workflow, pretty=True))
         
         self.log(f"Created workflow: {name}")
         return workflow
     
-    def execute_workflow(self, workflow: Dict[str, Any]) -> bool:
-        """Execute a workflow definition"""
+    def load_workflow(self, name: str) -> Dict[str, Any]:
+        """Load a workflow saved by create_workflow
         
-        self.log(f"Executing workflow: {workflow['name']}")
+        The saved ``dag`` is dropped if the steps were edited after it was
+        compiled, so execute_workflow rebuilds it from the step names.
+        """
         
-        for i, step in enumerate(workflow["steps"]):
-            self.log(f"Step {i+1}/{len(workflow['steps'])}: {step.get('name', 'Unnamed')}")
-            
-            # Check step type
-            step_type = step.get("type", "claude_code")
+        slug = name.lower().replace(' ', '-')
+        json_file = Path("workflows") / f"{slug}.json"
+        
+        loads = orjson.loads if orjson is not None else json.loads
+        workflow = loads(json_file.read_bytes())
+        
+        if workflow.get("dag_digest") != self._steps_digest(workflow["steps"]):
+            workflow.pop("dag", None)
+        return workflow
+    
+    @staticmethod
+    def _steps_digest(steps: List[Dict[str, Any]]) -> str:
+        """Fingerprint the steps a compiled DAG belongs to"""
+        return hashlib.sha256(json.dumps(steps, sort_keys=True).encode()).hexdigest()
+    
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        """Write data to path so readers never see a partial file"""
+        
+        tmp_file = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, path)
+    
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Return the concurrency limiter bound to the running event loop"""
+        
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphore_loop is not loop:
+            self._semaphore = asyncio.Semaphore(self.max_parallel)
+            self._semaphore_loop = loop
+        return self._semaphore
+    
+    def _condition_history(self) -> Tuple[Any, ...]:
+        """Return a read-only view of workflow_history, copying only new records"""
+        
+        view = self._history_view
+        if len(view) != len(self.workflow_history):
+            if len(view) > len(self.workflow_history):
+                view = ()
+            new = self.workflow_history[len(view):]
+            view = self._history_view = view + tuple(_readonly(r) for r in new)
+        return view
+    
+    def _condition_env(self) -> MappingProxyType:
+        """Return a read-only copy of the environment, refreshed when its size changes"""
+        
+        if self._env_view is None or len(self._env_view) != len(os.environ):
+            self._env_view = MappingProxyType(dict(os.environ))
+        return self._env_view
+    
+    def _evaluate_condition(self, condition: str) -> bool:
+        """Evaluate a conditional step expression against workflow state
+        
+        Expressions are compiled once and run with only ``history`` (the
+        workflow history), ``env`` (the environment) and a few builtins in
+        scope. Both are read-only copies, so a condition cannot change
+        orchestrator state or the environment of later claude processes.
+        The copies are cached and only rebuilt when history grows or
+        variables are added to or removed from the environment.
+        Every node of the parsed expression is checked first: names and
+        attributes starting with an underscore, calls to anything but
+        CONDITION_BUILTINS and CONDITION_METHODS, lambdas, comprehensions
+        and generator expressions are rejected.
+        """
+        
+        try:
+            code = self._cond_cache.get(condition)
+            if code is None:
+                tree = ast.parse(condition, "<workflow>", mode="eval")
+                for node in ast.walk(tree):
+                    if isinstance(node, FORBIDDEN_CONDITION_NODES):
+                        raise ValueError(f"{type(node).__name__} is not allowed")
+                    if isinstance(node, ast.Name) and node.id.startswith("_"):
+                        raise ValueError(f"name {node.id!r} is not allowed")
+                    if isinstance(node, ast.Attribute) and node.attr.startswith("_"):
+                        raise ValueError(f"attribute {node.attr!r} is not allowed")
+                    if isinstance(node, ast.Call):
+                        func = node.func
+                        if isinstance(func, ast.Attribute):
+                            if func.attr not in CONDITION_METHODS:
+                                raise ValueError(f"method {func.attr!r} is not allowed")
+                        elif not (isinstance(func, ast.Name) and func.id in CONDITION_BUILTINS):
+                            raise ValueError("only builtins and allowed methods can be called")
+                code = compile(tree, "<workflow>", "eval")
+                self._cond_cache[condition] = code
             
-            if step_type == "claude_code":
-                result = self.run_claude_code(
+            return bool(eval(
+                code,
+                {"__builtins__": CONDITION_BUILTINS},
+                {
+                    "history": self._condition_history(),
+                    "env": self._condition_env()
+                }
+            ))
+        except Exception as e:
+            self.log(f"Invalid condition {condition!r}: {e}", "ERROR")
+            return False
+    
+    async def _run_step_async(
+        self,
+        step: Dict[str, Any],
+        workflow: Dict[str, Any]
+    ) -> bool:
+        """Execute a single workflow step, returning False if a required step failed"""
+        
+        # Check step type
+        step_type = step.get("type", "claude_code")
+        
+        if step_type == "claude_code":
+            async with self._get_semaphore():
+                result = await self._run_claude_code_async(
                     step["prompt"],
-                    [ClaudeTool(tool) for tool in step.get("tools", [])],
-                    ThinkLevel(step.get("think_level", "")),
+                    [_tool(tool) for tool in step.get("tools", [])],
+                    _think(step.get("think_level", "")),
                     step.get("timeout")
                 )
+            
+            if not result and step.get("required", True):
+                self.log(f"Required step failed: {step.get('name')}", "ERROR")
+                return False
                 
-                if not result and step.get("required", True):
-                    self.log(f"Required step failed: {step.get('name')}", "ERROR")
+        elif step_type == "parallel":
+            # Run parallel tasks, resolving their tools and think levels
+            parallel_tasks = [
+                {
+                    **task,
+                    "tools": [_tool(tool) for tool in task.get("tools", [])],
+                    "think_level": _think(task.get("think_level", ""))
+                }
+                for task in step.get("tasks", [])
+            ]
+            results = await self.run_parallel_tasks(parallel_tasks)
+            
+            # Check if any required tasks failed
+            for j, (task, result) in enumerate(zip(parallel_tasks, results)):
+                if not result and task.get("required", True):
+                    self.log(f"Required parallel task {j+1} failed", "ERROR")
                     return False
                     
-            elif step_type == "parallel":
-                # Run parallel tasks
-                parallel_tasks = step.get("tasks", [])
-                results = asyncio.run(self.run_parallel_tasks(parallel_tasks))
-                
-                # Check if any required tasks failed
-                for j, (task, result) in enumerate(zip(parallel_tasks, results)):
-                    if not result and task.get("required", True):
-                        self.log(f"Required parallel task {j+1} failed", "ERROR")
-                        return False
-                        
-            elif step_type == "wait":
-                # Wait step
-                wait_time = step.get("seconds", 1)
-                self.log(f"Waiting {wait_time} seconds...")
-                time.sleep(wait_time)
-                
-            elif step_type == "conditional":
-                # Conditional execution
-                condition = step.get("condition")
-                if condition and eval(condition):
-                    # Execute conditional steps
-                    sub_workflow = {
-                        "name": f"{workflow['name']} - Conditional",
-                        "steps": step.get("steps", [])
-                    }
-                    self.execute_workflow(sub_workflow)
+        elif step_type == "wait":
+            # Wait step
+            wait_time = step.get("seconds", 1)
+            self.log(f"Waiting {wait_time} seconds...")
+            await asyncio.sleep(wait_time)
+            
+        elif step_type == "conditional":
+            # Conditional execution
+            condition = step.get("condition")
+            if condition and self._evaluate_condition(condition):
+                # Execute conditional steps
+                sub_workflow = {
+                    "name": f"{workflow['name']} - Conditional",
+                    "steps": step.get("steps", [])
+                }
+                await self.execute_workflow(sub_workflow)
+        
+        return True
+    
+    async def execute_workflow(self, workflow: Dict[str, Any]) -> bool:
+        """Execute a workflow definition
+        
+        Steps may list the names of other steps in ``depends_on``; every step
+        whose dependencies have completed runs concurrently with the others
+        in the same wave. Steps without ``depends_on`` are independent.
+        Workflows from create_workflow and load_workflow carry a
+        precompiled ``dag``, which is only used while its ``dag_digest``
+        still matches the steps.
+        """
+        
+        self.log(f"Executing workflow: {workflow['name']}")
+        
+        steps = workflow["steps"]
+        dag = workflow.get("dag")
+        if dag is None or workflow.get("dag_digest") != self._steps_digest(steps):
+            try:
+                dag = _compile_dag(steps)
+            except ValueError as e:
+                self.log(str(e), "ERROR")
+                return False
+        
+        pending = {i: set(deps) for i, deps in enumerate(dag)}
+        completed = set()
+        while pending:
+            ready = [i for i, deps in pending.items() if deps <= completed]
+            if not ready:
+                stuck = [_step_name(steps[i], i) for i in pending]
+                self.log(f"Dependency cycle between steps: {stuck}", "ERROR")
+                return False
+            
+            for i in ready:
+                self.log(f"Step {i+1}/{len(steps)}: {steps[i].get('name', 'Unnamed')}")
+            
+            results = await asyncio.gather(
+                *[self._run_step_async(steps[i], workflow) for i in ready]
+            )
+            
+            for i in ready:
+                del pending[i]
+                completed.add(i)
+            
+            if not all(results):
+                return False
         
         self.log(f"Workflow completed: {workflow['name']}")
         return True
     
-    def save_history(self, filename: str = "workflow-history.json"):
-        """Save workflow execution history"""
+    def save_history(self, filename: str = "workflow-history.jsonl"):
+        """Append history records not yet saved to a JSON Lines file"""
         
-        with open(filename, 'w') as f:
-            json.dump(self.workflow_history, f, indent=2)
+        new_records = self.workflow_history[self._history_flushed_idx:]
+        if new_records:
+            with open(filename, 'ab') as f:
+                f.write(b"".join(dump_json(record) + b"\n" for record in new_records))
+            self._history_flushed_idx += len(new_records)
         
         self.log(f"Saved workflow history to {filename}")
+    
+    @staticmethod
+    def load_history(filename: str = "workflow-history.jsonl") -> List[Dict[str, Any]]:
+        """Read history records written by save_history"""
+        
+        loads = orjson.loads if orjson is not None else json.loads
+        with open(filename, 'rb') as f:
+            return [loads(line) for line in f if line.strip()]
 
 # Example workflows
 def create_example_workflows(orchestrator: ClaudeOrchestrator):
@@ -235,6 +1237,7 @@ def create_example_workflows(orchestrator: ClaudeOrchestrator):
             {
                 "name": "Write Tests",
                 "type": "claude_code",
+                "depends_on": ["Analyze Requirements"],
                 "prompt": "Write comprehensive tests based on requirements. No implementation.",
                 "tools": ["WRITE", "EDIT"],
                 "think_level": "think"
@@ -242,6 +1245,7 @@ def create_example_workflows(orchestrator: ClaudeOrchestrator):
             {
                 "name": "Implement Feature",
                 "type": "claude_code",
+                "depends_on": ["Write Tests"],
                 "prompt": "Implement the feature to make all tests pass.",
                 "tools": ["EDIT", "WRITE", "READ", "BASH"],
                 "think_level": "ultrathink"
@@ -278,6 +1282,7 @@ def create_example_workflows(orchestrator: ClaudeOrchestrator):
             {
                 "name": "Synthesize Results",
                 "type": "claude_code",
+                "depends_on": ["Parallel Analysis"],
                 "prompt": "Synthesize all analysis results into a comprehensive report",
                 "tools": ["WRITE"],
                 "think_level": "think"
@@ -287,7 +1292,7 @@ def create_example_workflows(orchestrator: ClaudeOrchestrator):
 
 if __name__ == "__main__":
     # Example usage
-    orchestrator = ClaudeOrchestrator(debug=True)
+    orchestrator = ClaudeOrchestrator(debug=True, use_cache="--no-cache" not in sys.argv)
     
     # Create example workflows
     create_example_workflows(orchestrator)
@@ -301,3 +1306,4 @@ if __name__ == "__main__":
     
     # Save history
     orchestrator.save_history()
+    orchestrator.close()
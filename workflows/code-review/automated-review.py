@@ -6,124 +6,287 @@ Combines multiple perspectives for comprehensive code review
 
 import subprocess
 import json
+import re
 import sys
+import time
 from datetime import datetime
+from string import Template
 import os
 
-def run_claude_code(prompt, tools=None, think_level="think"):
-    """Execute Claude Code with review focus"""
-    cmd = ["claude", "-p", f"{think_level} {prompt}"]
-    
-    if tools:
-        cmd.extend(["--allowedTools"] + tools)
-    
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    return result.stdout if result.returncode == 0 else None
+import anthropic
+
+MODEL = os.getenv('CLAUDE_MODEL', 'claude-sonnet-4-5')
+MAX_TOKENS = 4096
+
+# Roughly 100k tokens; larger diffs would overflow every reviewer's context
+MAX_DIFF_CHARS = 400_000
+
+ROLES = ["security", "performance", "quality", "testing", "architecture"]
+
+REVIEWER_TITLES = {
+    "security": "Security Reviewer",
+    "performance": "Performance Analyst",
+    "quality": "Code Quality Inspector",
+    "testing": "Test Coverage Analyst",
+    "architecture": "Architecture Reviewer",
+}
+
+REVIEW_CHECKLISTS = {
+    "security": """
+- Check for vulnerabilities
+- Review authentication/authorization
+- Identify data exposure risks
+- Check input validation""",
+    "performance": """
+- Identify bottlenecks
+- Check for N+1 queries
+- Review algorithm complexity
+- Memory usage concerns""",
+    "quality": """
+- Check design patterns
+- Review naming conventions
+- Identify code smells
+- Assess maintainability""",
+    "testing": """
+- Review test completeness
+- Check edge cases
+- Identify missing tests
+- Assess test quality""",
+    "architecture": """
+- Check architectural decisions
+- Review component coupling
+- Assess scalability
+- Identify technical debt""",
+}
+
+SYSTEM_PROMPT = """
+You are a {title} on a code review panel.
+
+Review the pull request you are given, focusing on:{checklist}
+
+- Analyze only your specific area
+- Provide findings with severity (High/Medium/Low)
+- Suggest specific improvements
+
+Output MUST be a markdown section starting with '## {title}', followed by
+'Severity: High', 'Severity: Medium' and 'Severity: Low' lines, each
+followed by a bullet list of findings ('- None' if there are none).
+Do not include any preamble.
+"""
+
+SEVERITIES = ["High", "Medium", "Low"]
+SEVERITY_LINE = re.compile(r"^\s*(?:#+\s*)?\**Severity:\**\s*(High|Medium|Low)\b", re.IGNORECASE)
+# Only top-level bullets are findings; indented ones are details of a finding
+FINDING_LINE = re.compile(r"^(?:[-*]|\d+[.)])\s+(?!None\b)\S", re.IGNORECASE)
+# A bold line such as '**1. SQL injection**' titles a finding; the bullets
+# that follow it are its details
+FINDING_TITLE = re.compile(r"^\*\*(?:\d+[.)]\s*)?(?!None\b)[^*\s][^*]*\*\*", re.IGNORECASE)
+
+# Per-role instructions, sent after the shared (cached) PR diff
+SYSTEM_BY_ROLE = {
+    role: SYSTEM_PROMPT.format(
+        title=REVIEWER_TITLES[role],
+        checklist=REVIEW_CHECKLISTS[role]
+    )
+    for role in ROLES
+}
+
+REPORT_TEMPLATE = Template("""# Code Review: PR #$pr_number
+
+_Generated $date by the automated multi-perspective review._
+
+## Executive Summary
+
+| Reviewer | High | Medium | Low |
+|----------|------|--------|-----|
+$summary_rows
+| **Total** | $high | $medium | $low |
+$missing
+$sections
+""")
+
+def fetch_pr_diff(pr_number):
+    """
+    Fetch the PR diff for reviewers that cannot read the repository
+
+    Returns None if gh fails or the diff is empty.
+    """
+    result = subprocess.run(
+        ["gh", "pr", "diff", str(pr_number)],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(f"❌ Could not fetch diff for PR #{pr_number}: {result.stderr.strip()}")
+        return None
+    if not result.stdout.strip():
+        print(f"❌ PR #{pr_number} has an empty diff")
+        return None
+    return result.stdout
+
+def wait_for_batch(client, batch_id):
+    """
+    Poll a message batch until processing has ended
+    """
+    delay = 5
+    while True:
+        batch = client.messages.batches.retrieve(batch_id)
+        if batch.processing_status == "ended":
+            return batch
+        time.sleep(delay)
+        delay = min(delay * 2, 60)
 
 def multi_perspective_review(pr_number):
     """
-    Review code from multiple perspectives using Task
+    Review code from multiple perspectives in one Message Batch
+
+    Each reviewer role is an independent batch request, returned as a
+    dict of findings keyed by role. The diff is the large prefix shared by
+    all five requests, so it comes first in the system prompt and carries
+    the cache breakpoint; the short role instructions follow it.
     """
     
     print(f"🔍 Starting multi-perspective review for PR #{pr_number}")
     
-    review_prompt = f"""
-    Use Task to spawn 5 specialized review agents for PR #{pr_number}:
-    
-    1. Security Reviewer:
-       - Check for vulnerabilities
-       - Review authentication/authorization
-       - Identify data exposure risks
-       - Check input validation
-    
-    2. Performance Analyst:
-       - Identify bottlenecks
-       - Check for N+1 queries
-       - Review algorithm complexity
-       - Memory usage concerns
-    
-    3. Code Quality Inspector:
-       - Check design patterns
-       - Review naming conventions
-       - Identify code smells
-       - Assess maintainability
-    
-    4. Test Coverage Analyst:
-       - Review test completeness
-       - Check edge cases
-       - Identify missing tests
-       - Assess test quality
-    
-    5. Architecture Reviewer:
-       - Check architectural decisions
-       - Review component coupling
-       - Assess scalability
-       - Identify technical debt
-    
-    Each agent should:
-    - Read the PR changes
-    - Analyze their specific area
-    - Provide findings with severity (High/Medium/Low)
-    - Suggest specific improvements
-    
-    Synthesize all findings into a comprehensive review.
-    """
+    diff = fetch_pr_diff(pr_number)
+    if diff is None:
+        return None
+    if len(diff) > MAX_DIFF_CHARS:
+        print(f"❌ Diff is {len(diff)} characters, over the {MAX_DIFF_CHARS} limit for review")
+        return None
     
-    return run_claude_code(
-        review_prompt,
-        tools=["Task", "Read", "Bash", "Write"],
-        think_level="ultrathink"
-    )
+    client = anthropic.Anthropic()
+    batch = client.messages.batches.create(requests=[
+        {
+            "custom_id": role,
+            "params": {
+                "model": MODEL,
+                "max_tokens": MAX_TOKENS,
+                "system": [
+                    {
+                        "type": "text",
+                        "text": f"Pull request under review: PR #{pr_number}\n\nDiff:\n{diff}",
+                        "cache_control": {"type": "ephemeral"}
+                    },
+                    {
+                        "type": "text",
+                        "text": SYSTEM_BY_ROLE[role]
+                    }
+                ],
+                "messages": [{
+                    "role": "user",
+                    "content": f"Review PR #{pr_number}."
+                }]
+            }
+        }
+        for role in ROLES
+    ])
+    
+    print(f"⏳ Waiting for review batch {batch.id}...")
+    wait_for_batch(client, batch.id)
+    
+    results = {}
+    cached_tokens = 0
+    for entry in client.messages.batches.results(batch.id):
+        if entry.result.type != "succeeded":
+            print(f"⚠️  {entry.custom_id} review failed: {entry.result.type}")
+            continue
+        message = entry.result.message
+        results[entry.custom_id] = "".join(
+            block.text for block in message.content
+            if block.type == "text"
+        )
+        cached_tokens += message.usage.cache_read_input_tokens or 0
+    
+    print(f"🗄️  Prompt cache served {cached_tokens} input tokens")
+    return results or None
 
-def generate_review_report(review_results, pr_number):
+def count_findings(section):
     """
-    Generate formatted review report
+    Count top-level bullet or numbered findings under each 'Severity:'
+    line of a reviewer section
+
+    A severity applies until the next markdown heading, so bullets under
+    e.g. '### Recommendations' are not counted. Once a severity has a bold
+    finding title, the bullets after it are that finding's details. Warns
+    when a section has findings but no recognizable severity lines.
+    """
+    counts = dict.fromkeys(SEVERITIES, 0)
+    severity = None
+    titled = False
+    rated = False
+    unrated = 0
+    for line in section.splitlines():
+        match = SEVERITY_LINE.match(line)
+        if match:
+            severity = match.group(1).capitalize()
+            titled = False
+            rated = True
+        elif line.startswith("#"):
+            severity = None
+            titled = False
+        else:
+            if FINDING_TITLE.match(line):
+                titled = True
+            elif titled or not FINDING_LINE.match(line):
+                continue
+            if severity:
+                counts[severity] += 1
+            else:
+                unrated += 1
+    if not rated and unrated:
+        title = section.splitlines()[0].lstrip("# ")
+        print(f"⚠️  {title}: {unrated} findings but no 'Severity:' lines; counted as 0")
+    return counts
+
+def write_review_report(review_results, pr_number):
+    """
+    Concatenate the reviewer sections under a locally computed summary
     """
     
-    report_prompt = f"""
-    Create a professional code review report for PR #{pr_number}:
+    sections = []
+    counts = {}
+    for role in ROLES:
+        if role not in review_results:
+            continue
+        section = review_results[role].strip()
+        if not section.startswith("## "):
+            section = f"## {REVIEWER_TITLES[role]}\n\n{section}"
+        sections.append(section)
+        counts[role] = count_findings(section)
     
-    Review Results:
-    {review_results}
+    missing = [REVIEWER_TITLES[role] for role in ROLES if role not in review_results]
+    totals = {sev: sum(c[sev] for c in counts.values()) for sev in SEVERITIES}
     
-    Format the report with:
-    1. Executive Summary
-    2. Critical Issues (must fix)
-    3. Important Issues (should fix)
-    4. Suggestions (nice to have)
-    5. Positive Aspects
-    6. Recommended Actions
+    report = REPORT_TEMPLATE.substitute(
+        pr_number=pr_number,
+        date=datetime.now().strftime("%Y-%m-%d %H:%M"),
+        summary_rows="\n".join(
+            f"| {REVIEWER_TITLES[role]} | {c['High']} | {c['Medium']} | {c['Low']} |"
+            for role, c in counts.items()
+        ),
+        high=totals["High"],
+        medium=totals["Medium"],
+        low=totals["Low"],
+        missing=f"\nNo results from: {', '.join(missing)}.\n" if missing else "",
+        sections="\n\n".join(sections)
+    )
     
-    Use markdown formatting.
-    Save as 'pr-{pr_number}-review.md'
-    """
+    review_file = f"pr-{pr_number}-review.md"
+    with open(review_file, 'w') as f:
+        f.write(report)
     
-    return run_claude_code(
-        report_prompt,
-        tools=["Write"],
-        think_level="think"
-    )
+    return review_file
 
 def post_review_comment(pr_number, review_file):
     """
     Post review as PR comment
     """
     
-    post_prompt = f"""
-    Post the review from {review_file} as a comment on PR #{pr_number}.
-    
-    Use gh CLI to:
-    1. Read the review file
-    2. Post as a comment
-    3. Add appropriate labels based on findings
-    4. Request changes if critical issues found
-    """
-    
-    return run_claude_code(
-        post_prompt,
-        tools=["Read", "Bash"],
-        think_level="think"
+    result = subprocess.run(
+        ["gh", "pr", "comment", str(pr_number), "--body-file", review_file]
     )
+    return result.returncode == 0
 
 def automated_review_workflow(pr_number):
     """
@@ -142,14 +305,15 @@ def automated_review_workflow(pr_number):
             print("❌ Review failed")
             return False
         
-        # Step 2: Generate report
-        print("\n📝 Step 2: Generating review report...")
-        report = generate_review_report(review_results, pr_number)
+        # Step 2: Write report
+        print("\n📝 Step 2: Writing review report...")
+        review_file = write_review_report(review_results, pr_number)
         
         # Step 3: Post to PR
         print("\n💬 Step 3: Posting review to PR...")
-        review_file = f"pr-{pr_number}-review.md"
-        post_result = post_review_comment(pr_number, review_file)
+        if not post_review_comment(pr_number, review_file):
+            print("❌ Failed to post review comment")
+            return False
         
         print("\n✅ Review completed successfully!")
         print(f"📄 Review saved to: {review_file}")